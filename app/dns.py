@@ -1,20 +1,20 @@
+import socket
 import struct
 from dataclasses import dataclass
+from functools import lru_cache
 
 
-@dataclass
+@dataclass(slots=True)
 class DNSHeader:
     packet_id: int
     operation_code: int
     recursion_desired: int
     response_code: int
     question_count: int
+    answer_count: int = 0
 
 
 class DNSMessage:
-    # Packet Identifier
-    ID: int
-
     # Query/Response Indicator (QR)
     # 1 for a reply packet, 0 for a question packet.
     # Since we're yielding replies, we default this to 1.
@@ -32,20 +32,48 @@ class DNSMessage:
     # https://www.rfc-editor.org/rfc/rfc1035#section-3.2.1
     TTL = 60
 
+    # For now we'll keep a hardcoded IP address
+    IP_ADDRESS = "8.8.8.8"
+    # inet_aton gives us the 4 raw octets of the address directly
+    RDATA = socket.inet_aton(IP_ADDRESS)
+
+    # Everything after the name is constant, so we pack it once up front.
+    # Question: TYPE (16 bits) and CLASS (16 bits)
+    QUESTION_TAIL = struct.pack("!HH", TYPE, CLASS)
+    # Answer: TYPE (16 bits), CLASS (16 bits), TTL (32 bits),
+    # RDLENGTH (16 bits) and RDATA (4 octets for an IPv4 address)
+    ANSWER_TAIL = struct.pack("!HHIH", TYPE, CLASS, TTL, len(RDATA)) + RDATA
+
     # https://www.rfc-editor.org/rfc/rfc1035#section-4.1.1
-    HEADER_FORMAT = "!HBBHHHH"
     HEADER_SIZE = 12
 
+    # How many names (or queries) each of our caches holds on to.
+    # Shared by every cache so they all evict at the same point.
+    CACHE_SIZE = 4096
+
+    # Record types whose RDATA holds domain names, which upstream may compress
+    # just like owner names. Each maps to the number of bytes ahead of the
+    # name(s) and how many names follow. Newer types never compress their names.
+    # https://www.rfc-editor.org/rfc/rfc3597#section-4
+    RDATA_NAMES = {
+        2: (0, 1),  # NS: NSDNAME
+        5: (0, 1),  # CNAME: CNAME
+        6: (0, 2),  # SOA: MNAME and RNAME, followed by five 32-bit fields
+        12: (0, 1),  # PTR: PTRDNAME
+        15: (2, 1),  # MX: 16-bit PREFERENCE, then EXCHANGE
+    }
+
     # https://www.rfc-editor.org/rfc/rfc1035#section-4.1.4
     IS_COMPRESSED_LABEL_MASK = 0b1100_0000
     LABEL_POINTER_MASK = 0b0011_1111
 
-    def __init__(self, packet_id: int, indicator: int = 1):
-        self.ID = packet_id
-        self.QR = indicator
-
+    @classmethod
     def create_header(
-        self, query_header: DNSHeader, question_count: int, answer_count: int
+        cls,
+        query_header: DNSHeader,
+        question_count: int,
+        answer_count: int,
+        indicator: int = QR,
     ) -> bytes:
         """
         Creates a 12-byte DNS header with the specified fields.
@@ -76,7 +104,7 @@ class DNSMessage:
         # 10001111  = 143 in decimal
         #
         flags1 = (
-            (self.QR << 7)
+            (indicator << 7)
             | (query_header.operation_code << 3)
             | (0 << 2)
             | (0 << 1)
@@ -95,49 +123,47 @@ class DNSMessage:
         nscount = 0  # Authority Record Count
         arcount = 0  # Additional Record Count
 
-        # Pack everything into a binary string
-        # '!' means network byte order (big-endian)
-        # 'H' means 16-bit unsigned short
-        # 'BB' means two 8-bit unsigned chars (for the flags)
-        # HBBHHHH = H + 2B + 4H = 2*1 + 5*2 = 12 bytes
-        return struct.pack(
-            self.HEADER_FORMAT,
-            query_header.packet_id,  # 16 bits
-            flags1,  # 8 bits
-            flags2,  # 8 bits
-            qdcount,  # 16 bits
-            ancount,  # 16 bits
-            nscount,  # 16 bits
-            arcount,  # 16 bits
+        # Pack everything into a binary string.
+        # The header follows the HBBHHHH layout (H + 2B + 4H = 12 bytes),
+        # so we place each field at its bit position in a single 96-bit
+        # integer and write it out in network byte order (big-endian)
+        header = (
+            (query_header.packet_id << 80)  # 16 bits
+            | (flags1 << 72)  # 8 bits
+            | (flags2 << 64)  # 8 bits
+            | (qdcount << 48)  # 16 bits
+            | (ancount << 32)  # 16 bits
+            | (nscount << 16)  # 16 bits
+            | arcount  # 16 bits
         )
+        return header.to_bytes(cls.HEADER_SIZE, "big")
 
-    def create_question(self, domain_name: str) -> str:
-        name = self._as_label_sequence(domain_name)
-
-        question_type = self._as_string_of_bytes(self.TYPE, length=2)
-        question_class = self._as_string_of_bytes(self.CLASS, length=2)
-
-        return name + question_type + question_class
-
-    def create_answer(self, domain_name: str) -> str:
-        name = self._as_label_sequence(domain_name)
-
-        answer_type = self._as_string_of_bytes(self.TYPE, length=2)
-        answer_class = self._as_string_of_bytes(self.CLASS, length=2)
-        ttl = self._as_string_of_bytes(60, length=4)
-
-        # For now we'll keep a hardcoded IP address
-        ip_address = "8.8.8.8"
-        data = "".join([chr(int(piece)) for piece in ip_address.split(".")])
-        length = self._as_string_of_bytes(len(data), length=2)
+    # Like a caching nameserver, we keep the wire form of the records we
+    # handed out recently, so repeated queries for a name skip serialization.
+    # Since TTL and address are constant for now, entries never go stale.
+    @classmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def create_question(cls, labels: tuple[bytes, ...]) -> bytes:
+        return cls._as_label_sequence(labels) + cls.QUESTION_TAIL
 
-        return name + answer_type + answer_class + ttl + length + data
+    @classmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def create_answer(cls, labels: tuple[bytes, ...]) -> bytes:
+        return cls._as_label_sequence(labels) + cls.ANSWER_TAIL
 
     @classmethod
-    def parse_header(cls, header: bytes) -> DNSHeader:
-        packet_id, flags1, _flags2, qdcount, _ancount, _nsacount, _arcount = (
-            struct.unpack(cls.HEADER_FORMAT, header)
-        )
+    def parse_header(cls, header: bytes | memoryview) -> DNSHeader:
+        # We only need ID, the 1st flag byte, QDCOUNT and ANCOUNT, so rather than
+        # unpacking all seven fields we read the header as one 96-bit integer
+        # and shift out the ones we care about:
+        # ID (bits 95-80) | flags1 (79-72) | flags2 (71-64) | QDCOUNT (63-48) |
+        # ANCOUNT (47-32) | ...
+        value = int.from_bytes(header, "big")
+        packet_id = (value >> 80) & 0xFFFF
+        flags1 = (value >> 72) & 0xFF
+        qdcount = (value >> 48) & 0xFFFF
+        ancount = (value >> 32) & 0xFFFF
+
         # Recall that OPCODE is shifted 3 positions to the left
         # We need to shift it to the right before applying our mask
         opcode = (flags1 >> 3) & 0b00001111
@@ -152,59 +178,126 @@ class DNSMessage:
             recursion_desired=rd_bit,
             response_code=rcode,
             question_count=qdcount,
+            answer_count=ancount,
         )
 
     @classmethod
-    def parse_question(cls, packet: bytes, offset: int) -> tuple[str, int]:
-        pieces = []
-
-        # Labels end at a null byte
-        while (length := packet[offset]) != 0:
-            if offset + length >= len(packet) - 1:
-                # Avoid overflowing
-                break
-
-            if cls._is_compressed_label(length):
-                piece, offset = cls._follow_label_pointer(packet, offset, length)
-            else:
-                piece, offset = cls._decode_label(packet, offset, length)
-            pieces.append(piece)
-
-        # Skip the 4 bytes for TYPE and CLASS, plus a byte for the null terminator
-        offset += 4 + 1
+    def parse_question(
+        cls, packet: bytes | memoryview, offset: int
+    ) -> tuple[tuple[bytes, ...], int]:
+        labels, offset = cls._parse_labels(packet, offset)
 
-        return ".".join(pieces), offset
+        # Skip the 4 bytes for TYPE and CLASS
+        offset += 4
 
-    @classmethod
-    def parse_answer(cls, packet: bytes, offset: int) -> tuple[str, int]:
-        print("packet ", packet)
-        print("offset ", offset)
-        return packet.decode(), offset
+        # We only ever echo names back, so there's no need to decode them.
+        # The raw labels are returned as a tuple so they can be used as a key.
+        return tuple(labels), offset
 
     @classmethod
-    def _is_compressed_label(cls, length: int) -> bool:
-        return bool(length & cls.IS_COMPRESSED_LABEL_MASK)
+    def parse_answer(cls, packet: bytes | memoryview, offset: int) -> tuple[bytes, int]:
+        """
+        Reads the resource record at `offset` and returns it in wire format,
+        with its names written out in full. A compressed name points somewhere
+        else in `packet`, so the record can't be copied into another packet as is.
+        """
+        labels, offset = cls._parse_labels(packet, offset)
+
+        # TYPE (16 bits), CLASS (16 bits), TTL (32 bits) and RDLENGTH (16 bits),
+        # followed by RDLENGTH bytes of RDATA
+        rdata_start = offset + 10
+        if rdata_start > len(packet):
+            raise ValueError("Resource record is truncated")
+        record_type = int.from_bytes(packet[offset : offset + 2], "big")
+        rdlength = int.from_bytes(packet[offset + 8 : rdata_start], "big")
+        end = rdata_start + rdlength
+        if end > len(packet):
+            raise ValueError("Resource record data is truncated")
+
+        rdata = bytes(packet[rdata_start:end])
+        if record_type in cls.RDATA_NAMES:
+            prefix_size, name_count = cls.RDATA_NAMES[record_type]
+            position = rdata_start + prefix_size
+            parts = [bytes(packet[rdata_start:position])]
+            for _ in range(name_count):
+                name, position = cls._parse_labels(packet, position)
+                parts.append(cls._as_label_sequence(tuple(name)))
+            if position > end:
+                raise ValueError("Resource record data is truncated")
+            parts.append(bytes(packet[position:end]))
+            # Expanding the names changes the length of RDATA
+            rdata = b"".join(parts)
+
+        return (
+            cls._as_label_sequence(tuple(labels))
+            + bytes(packet[offset : offset + 8])
+            + len(rdata).to_bytes(2, "big")
+            + rdata,
+            end,
+        )
 
     @classmethod
-    def _decode_label(cls, packet: bytes, offset: int, length: int) -> tuple[str, int]:
-        offset += 1
-        data = packet[offset : offset + length]
-        offset += length
-        return data.decode(), offset
+    def _parse_labels(
+        cls, packet: bytes | memoryview, offset: int
+    ) -> tuple[list[bytes], int]:
+        labels = []
+        # Once we jump through a pointer, the rest of the name lives elsewhere
+        # in the packet. Parsing resumes right after the (2 byte) pointer,
+        # so we remember that position the first time we jump.
+        return_offset = None
+        # Pointers we've already followed, so a malicious packet
+        # with a pointer loop can't keep us here forever
+        visited = set()
+
+        # Labels end at a null byte. A truncated packet may run out before that,
+        # so every read is checked against the end of the packet. Rather than
+        # hand back a partial name (which we'd happily answer for), we reject it.
+        end = len(packet)
+        while True:
+            if offset >= end:
+                raise ValueError("Name runs past the end of the packet")
+            length = packet[offset]
+            if length == 0:
+                break
 
-    @classmethod
-    def _follow_label_pointer(cls, packet: bytes, offset: int, length: int):
-        offset += 1
-        new_offset = ((length & cls.LABEL_POINTER_MASK) << 8) | packet[offset]
-        return cls.parse_question(packet, new_offset)
-
-    def _as_label_sequence(self, name: str) -> str:
-        result = ""
-        for label in name.split("."):
-            length = chr(len(label))
-            result += f"{length}{label}"
-        result += "\x00"
-        return result
-
-    def _as_string_of_bytes(self, number: int, length: int) -> str:
-        return number.to_bytes(length=length).decode()
+            # A pointer has its two most significant bits set
+            if length & cls.IS_COMPRESSED_LABEL_MASK:
+                if offset + 1 >= end:
+                    raise ValueError("Label pointer runs past the end of the packet")
+                pointer = ((length & cls.LABEL_POINTER_MASK) << 8) | packet[offset + 1]
+                if pointer in visited:
+                    raise ValueError(f"Label pointer loop at offset {pointer}")
+                visited.add(pointer)
+
+                if return_offset is None:
+                    return_offset = offset + 2
+                offset = pointer
+                continue
+
+            # The label must be followed by at least the null terminator
+            if offset + 1 + length >= end:
+                raise ValueError("Label runs past the end of the packet")
+
+            # Skip the length byte, then take the label itself.
+            # Labels outlive the packet (they're cache keys), so if we're
+            # reading from a view into a reused buffer we take a copy.
+            offset += 1
+            labels.append(bytes(packet[offset : offset + length]))
+            offset += length
+
+        if return_offset is None:
+            # Skip the null terminator
+            return_offset = offset + 1
+
+        return labels, return_offset
+
+    @staticmethod
+    def _as_label_sequence(labels: tuple[bytes, ...]) -> bytes:
+        # Each label is prefixed by its length and the sequence
+        # is terminated by the null label (a single zero byte)
+        parts = []
+        for label in labels:
+            parts.append(bytes((len(label),)))
+            parts.append(label)
+        parts.append(b"\x00")
+        return b"".join(parts)
@@ -1,121 +1,443 @@
+import asyncio
+import gc
+import os
+import selectors
+import signal
 import socket
+import sys
+import time
+import traceback
 from argparse import ArgumentParser
+from functools import lru_cache, partial
 
+from . import mmsg
 from .dns import DNSHeader, DNSMessage
+from .mmsg import MessageBatch
 
+# How long we wait on the resolver before giving up on a query (in seconds)
+UPSTREAM_TIMEOUT = 5
+
+# How many requests a worker may have waiting on the resolver at once.
+# Requests are told apart by their 16-bit ID, so this must stay below 65536.
+MAX_PENDING_UPSTREAM = 4096
+
+# Requested size of the kernel's send/receive buffers for our sockets (in bytes).
+# The default (~208KB on Linux) overflows under bursts, silently dropping queries.
+SOCKET_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Linux only and not exposed by the socket module, see socket(7)
+_SO_SNDBUFFORCE = 32
+_SO_RCVBUFFORCE = 33
+
+
+def _build_response(buf: bytes | memoryview) -> list[bytes]:
+    # Two queries for the same question(s) only differ in their ID.
+    # So we cache everything that follows the ID, keyed by the rest of the query,
+    # and repeated queries skip parsing and serialization altogether.
+    # The pieces are handed to the kernel as they are (see _drain).
+    return [bytes(buf[:2]), _response_without_id(bytes(buf[2:]))]
+
+
+@lru_cache(maxsize=DNSMessage.CACHE_SIZE)
+def _response_without_id(query: bytes) -> bytes:
+    # Parsing expects a whole packet, so we put a placeholder ID back in front
+    return b"".join(_create_response(b"\x00\x00" + query))[2:]
+
+
+def _parse_query_header(buf: bytes | memoryview) -> DNSHeader:
+    if len(buf) < DNSMessage.HEADER_SIZE:
+        raise ValueError("Packet is too short for a header")
+
+    # Slicing a memoryview doesn't copy the underlying bytes
+    header = memoryview(buf)[: DNSMessage.HEADER_SIZE]
+    query_header = DNSMessage.parse_header(header)
+
+    # Every question takes at least 5 bytes (an empty name, TYPE and CLASS),
+    # so a count the packet can't possibly hold means it's malformed.
+    # Acting on it anyway would blow up a tiny query into a huge response.
+    question_count = query_header.question_count
+    if question_count * 5 > len(buf) - DNSMessage.HEADER_SIZE:
+        raise ValueError(f"Packet is too short for {question_count} questions")
+
+    return query_header
+
+
+def _create_response(buf: bytes | memoryview) -> list[bytes]:
+    query_header = _parse_query_header(buf)
+    question_count = query_header.question_count
+
+    # The response is laid out as header, all questions, then all answers.
+    #
+    # Fast path: almost every query in the wild carries exactly one question,
+    # so we skip the loop and the list bookkeeping for it
+    if question_count == 1:
+        domain_name, offset = DNSMessage.parse_question(buf, DNSMessage.HEADER_SIZE)
+        if offset > len(buf):
+            raise ValueError("Question section is truncated")
+        return [
+            DNSMessage.create_header(query_header, question_count=1, answer_count=1),
+            DNSMessage.create_question(domain_name),
+            DNSMessage.create_answer(domain_name),
+        ]
+
+    # Otherwise we size the list up front and fill both sections in a single pass
+    parts = [b""] * (1 + 2 * question_count)
+    offset = DNSMessage.HEADER_SIZE
+    for i in range(question_count):
+        domain_name, offset = DNSMessage.parse_question(buf, offset=offset)
+        parts[1 + i] = DNSMessage.create_question(domain_name)
+        parts[1 + question_count + i] = DNSMessage.create_answer(domain_name)
+
+    if offset > len(buf):
+        raise ValueError("Question section is truncated")
+
+    parts[0] = DNSMessage.create_header(
+        query_header,
+        question_count=question_count,
+        answer_count=question_count,
+    )
+
+    return parts
+
+
+class _ErrorReporter:
+    """
+    Counts errors and prints at most one line about them every `interval` seconds.
+    Printing goes through stdout's lock, which under a flood of bad packets
+    would otherwise become a bottleneck of its own.
+    """
+
+    def __init__(self, interval: float = 10.0):
+        self.interval = interval
+        self.count = 0
+        self.next_report = 0.0
+
+    def record(self, context: str, error: Exception):
+        self.count += 1
+        now = time.monotonic()
+        if now >= self.next_report:
+            print(f"{context}: {error} ({self.count} error(s) since the last report)")
+            self.count = 0
+            self.next_report = now + self.interval
+
+
+_errors = _ErrorReporter()
+
+
+def _respond(buf: bytes | memoryview) -> list[bytes] | None:
+    # A malformed packet shouldn't take the server down with it,
+    # so we skip it and move on to the next one
+    try:
+        return _build_response(buf)
+    except Exception as e:
+        _errors.record("Error handling query", e)
+        return None
+
+
+def _drain(udp_socket: socket.SocketType, buffer: bytearray):
+    # Bind what we call for every packet to locals up front,
+    # so the loop doesn't repeat the attribute lookups
+    recvfrom_into = udp_socket.recvfrom_into
+    sendmsg = udp_socket.sendmsg
+    respond = _respond
+    view = memoryview(buffer)
 
-def _run_server(udp_socket: socket.SocketType):
     while True:
         try:
-            buf, source = udp_socket.recvfrom(512)
-
-            header = buf[: DNSMessage.HEADER_SIZE]
-            query_header = DNSMessage.parse_header(header)
-
-            offset = DNSMessage.HEADER_SIZE
-            domain_names = []
-            for _ in range(query_header.question_count):
-                domain_name, offset = DNSMessage.parse_question(buf, offset=offset)
-                domain_names.append(domain_name)
-
-            response_header = DNSMessage(query_header.packet_id).create_header(
-                query_header,
-                question_count=query_header.question_count,
-                answer_count=len(domain_names),
-            )
-            questions, answers = [], []
-            for domain_name in domain_names:
-                message = DNSMessage(packet_id=query_header.packet_id)
-                questions.append(message.create_question(domain_name))
-                answers.append(message.create_answer(domain_name))
-
-            response = response_header
-            response += "".join(questions).encode()
-            response += "".join(answers).encode()
-
-            udp_socket.sendto(response, source)
-        except Exception as e:
-            print(f"Error receiving data: {e}")
+            # Reading into the same buffer every time saves allocating
+            # a fresh bytes object per datagram
+            nbytes, source = recvfrom_into(buffer)
+        except BlockingIOError:
+            # Nothing left to read for now
+            break
+
+        # The buffer gets overwritten by the next datagram, so we respond
+        # right away. sendmsg takes the response pieces as separate buffers
+        # and the kernel gathers them into one datagram.
+        response = respond(view[:nbytes])
+        if response is not None:
+            sendmsg(response, [], 0, source)
+
+
+def _drain_batches(batch: MessageBatch):
+    respond = _respond
+    datagram = batch.datagram
+
+    # Same as _drain, but a whole batch of datagrams per syscall
+    while count := batch.recv():
+        batch.send([respond(datagram(i)) for i in range(count)])
+        if count < batch.size:
+            # We got less than we asked for, so the queue is empty
             break
 
 
-def _run_forwarding_server(udp_socket: socket.SocketType, address: str, port: int):
+def _run_server(udp_socket: socket.SocketType):
+    # Instead of blocking on one datagram at a time, we wait until the socket
+    # is readable and then drain everything the kernel has queued for us
+    udp_socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(udp_socket, selectors.EVENT_READ)
+
+    if mmsg.SUPPORTED:
+        drain = partial(_drain_batches, MessageBatch(udp_socket))
+    else:
+        drain = partial(_drain, udp_socket, bytearray(512))
+
+    select = selector.select
     while True:
-        # Receive
-        buf, source = udp_socket.recvfrom(512)
+        try:
+            select()
+            drain()
+        except Exception as e:
+            # e.g. a send failing for one client, keep serving everyone else
+            _errors.record("Error receiving data", e)
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    A single connected socket to the resolver, shared by every query a worker
+    forwards. Since many queries are in flight on it at once, each request is
+    sent under an ID of our own and responses are matched back by that ID.
+    """
+
+    def __init__(self):
+        self.transport = None
+        # Responses we're still waiting on, keyed by the ID of their request
+        self.pending: dict[int, asyncio.Future] = {}
+        self.next_id = 0
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        packet_id = int.from_bytes(data[:2], "big")
+        response = self.pending.pop(packet_id, None)
+        if response is not None and not response.done():
+            response.set_result(data)
+
+    def error_received(self, exc: Exception):
+        # We can't tell which request an ICMP error belongs to
+        for response in self.pending.values():
+            if not response.done():
+                response.set_exception(exc)
+
+    async def query(self, requests: list[bytes]) -> list[bytes]:
+        """
+        Sends all requests back to back and waits for all of their responses,
+        so the whole batch costs a single upstream round trip.
+        The responses carry our IDs, not the ones the requests came with.
+        """
+        # A slow (or silent) resolver shouldn't let requests pile up
+        # until we run out of IDs, so past a point we drop new queries
+        if len(self.pending) + len(requests) > MAX_PENDING_UPSTREAM:
+            raise RuntimeError("Too many requests waiting on the resolver")
+
+        loop = asyncio.get_running_loop()
+        packet_ids, responses = [], []
+        for request in requests:
+            packet_id = self._allocate_id()
+            response = loop.create_future()
+            self.pending[packet_id] = response
+            packet_ids.append(packet_id)
+            responses.append(response)
+            self.transport.sendto(packet_id.to_bytes(2, "big") + request[2:])
+
+        try:
+            # UDP may drop any of the packets. Rather than waiting forever,
+            # we give up and let the client retry.
+            return await asyncio.wait_for(asyncio.gather(*responses), UPSTREAM_TIMEOUT)
+        finally:
+            for packet_id in packet_ids:
+                self.pending.pop(packet_id, None)
+
+    def _allocate_id(self) -> int:
+        # IDs are 16 bits, skip over the ones still waiting on a response
+        for _ in range(0x10000):
+            packet_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFF
+            if packet_id not in self.pending:
+                return packet_id
+        raise RuntimeError("No packet ID left for a new request")
+
+
+async def _forward_query(buf: bytes, upstream: _UpstreamProtocol) -> bytes:
+    # Each question becomes a request of its own, so an implausible
+    # question count would have us flood the resolver on a client's behalf
+    query_header = _parse_query_header(buf)
+
+    if query_header.question_count <= 1:
+        # Forward buf as is, then put the client's ID back on the response
+        [response] = await upstream.query([buf])
+        return buf[:2] + response[2:]
+
+    offset = DNSMessage.HEADER_SIZE
 
-        header = buf[: DNSMessage.HEADER_SIZE]
-        query_header = DNSMessage.parse_header(header)
+    # Split questions
+    domain_names, requests = [], []
+    for _ in range(query_header.question_count):
+        domain_name, offset = DNSMessage.parse_question(buf, offset=offset)
+        domain_names.append(domain_name)
+        # Question header. The ID is filled in by the upstream.
+        request_header = DNSMessage.create_header(
+            DNSHeader(
+                packet_id=0,
+                operation_code=query_header.operation_code,
+                recursion_desired=query_header.recursion_desired,
+                response_code=query_header.response_code,
+                question_count=1,
+            ),
+            question_count=1,
+            answer_count=0,
+            indicator=0,
+        )
+        requests.append(request_header + DNSMessage.create_question(domain_name))
 
+    if offset > len(buf):
+        raise ValueError("Question section is truncated")
+
+    upstream_responses = await upstream.query(requests)
+
+    # Pull the answer records out of each response. Their names may be
+    # compressed, pointing into the upstream response, so parse_answer
+    # writes them out in full before they move into our response.
+    answers = []
+    for upstream_response in upstream_responses:
+        upstream_header = DNSMessage.parse_header(
+            memoryview(upstream_response)[: DNSMessage.HEADER_SIZE]
+        )
+        offset = DNSMessage.HEADER_SIZE
+        for _ in range(upstream_header.question_count):
+            _, offset = DNSMessage.parse_question(upstream_response, offset=offset)
+        for _ in range(upstream_header.answer_count):
+            answer, offset = DNSMessage.parse_answer(upstream_response, offset=offset)
+            answers.append(answer)
+
+    # Build the response header with the updated answer count
+    response_header = DNSMessage.create_header(
+        DNSHeader(
+            packet_id=query_header.packet_id,
+            operation_code=query_header.operation_code,
+            recursion_desired=query_header.recursion_desired,
+            response_code=query_header.response_code,
+            question_count=query_header.question_count,
+        ),
+        question_count=query_header.question_count,
+        answer_count=len(answers),
+    )
+
+    # All questions first, then all answers
+    parts = [response_header]
+    parts.extend(DNSMessage.create_question(name) for name in domain_names)
+    parts.extend(answers)
+
+    return b"".join(parts)
+
+
+class _ForwardingProtocol(asyncio.DatagramProtocol):
+    def __init__(self, upstream: _UpstreamProtocol):
+        self.upstream = upstream
+        self.transport = None
+        # The event loop only keeps weak references to tasks,
+        # so we hold on to the in-flight ones ourselves
+        self.tasks = set()
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, source: tuple[str, int]):
+        # Each query is handled in its own task, so a slow upstream
+        # doesn't hold up the queries arriving behind it
+        task = asyncio.create_task(self._forward(data, source))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _forward(self, buf: bytes, source: tuple[str, int]):
+        try:
+            response = await _forward_query(buf, self.upstream)
+        except Exception as e:
+            _errors.record("Error forwarding query", e)
+            return
+        # Respond
+        self.transport.sendto(response, source)
+
+
+async def _run_forwarding_server(
+    udp_socket: socket.SocketType, client_socket: socket.SocketType
+):
+    loop = asyncio.get_running_loop()
+    _, upstream = await loop.create_datagram_endpoint(
+        _UpstreamProtocol, sock=client_socket
+    )
+    await loop.create_datagram_endpoint(
+        lambda: _ForwardingProtocol(upstream), sock=udp_socket
+    )
+
+    # The protocol does all the work from here, we just keep the loop running
+    await loop.create_future()
+
+
+def _grow_socket_buffers(sock: socket.SocketType):
+    options = [
+        (socket.SO_RCVBUF, _SO_RCVBUFFORCE),
+        (socket.SO_SNDBUF, _SO_SNDBUFFORCE),
+    ]
+    for option, forced_option in options:
+        if sys.platform == "linux":
+            # The plain options are capped at net.core.rmem_max/wmem_max,
+            # the FORCE ones aren't but need CAP_NET_ADMIN
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, forced_option, SOCKET_BUFFER_SIZE)
+                continue
+            except PermissionError:
+                pass
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+
+
+def _run_worker(port: int, resolver: str | None, cpu: int | None):
+    if cpu is not None:
+        # Keep each worker on its own core, so its packets and
+        # caches stay warm there instead of bouncing between CPUs
+        os.sched_setaffinity(0, {cpu})
+
+    # AF_INET means we're using IPv4
+    # SOCK_DGRAM specifies UDP protocol (as opposed to TCP which would be SOCK_STREAM)
+    # DGRAM stands for (User) DataGram (Protocol), or UDP for short ;)
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # Every worker binds its own socket to the same address.
+    # With SO_REUSEPORT the kernel load-balances incoming datagrams across them.
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    udp_socket.bind(("127.0.0.1", port))
+    _grow_socket_buffers(udp_socket)
+
+    if resolver:
+        address, resolver_port = resolver.split(":")
+
+        # One socket to the resolver for the whole worker, rather than one per
+        # query. Connecting it lets the kernel skip the route lookup on each send.
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Lots of queries share this socket, so we give it room for bursts
+        _grow_socket_buffers(client_socket)
+        client_socket.connect((address, int(resolver_port)))
 
-        if query_header.question_count > 1:
-            offset = DNSMessage.HEADER_SIZE
-
-            # Split questions
-            answers = []
-            for _ in range(query_header.question_count):
-                domain_name, offset = DNSMessage.parse_question(buf, offset=offset)
-                # Question header
-                request_header = DNSMessage(
-                    query_header.packet_id, indicator=0
-                ).create_header(
-                    DNSHeader(
-                        packet_id=query_header.packet_id,
-                        operation_code=query_header.operation_code,
-                        recursion_desired=query_header.recursion_desired,
-                        response_code=query_header.response_code,
-                        question_count=1,
-                    ),
-                    question_count=1,
-                    answer_count=1,
-                )
-                message = DNSMessage(
-                    packet_id=query_header.packet_id,
-                )
-                request = request_header + message.create_question(domain_name).encode()
-                # Forward request
-                client_socket.sendto(request, (address, port))
-
-                # Receive
-                answers.append(client_socket.recv(512))
-
-            # Build the response header with the updated answer count
-            response_header = DNSMessage(query_header.packet_id).create_header(
-                DNSHeader(
-                    packet_id=query_header.packet_id,
-                    operation_code=query_header.operation_code,
-                    recursion_desired=query_header.recursion_desired,
-                    response_code=query_header.response_code,
-                    question_count=query_header.question_count,
-                ),
-                question_count=query_header.question_count,
-                answer_count=len(answers),
-            )
-            final_response = response_header
-
-            # Merge answers back together with their respective questions
-            for answer in answers:
-                # Question
-                offset = DNSMessage.HEADER_SIZE
-                domain_name, offset = DNSMessage.parse_question(answer, offset=offset)
-                message = DNSMessage(packet_id=query_header.packet_id)
-                final_response += message.create_question(domain_name).encode()
-                # Answer
-                final_response += answer[DNSMessage.HEADER_SIZE :]
-
-            # Forward
-            udp_socket.sendto(final_response, source)
-        else:
-            # Forward buf as is
-            client_socket.sendto(buf, (address, port))
-            # Receive
-            server_response = client_socket.recv(512)
-            # Respond
-            udp_socket.sendto(server_response, source)
+        asyncio.run(_run_forwarding_server(udp_socket, client_socket))
+    else:
+        _run_server(udp_socket)
 
 
-def main():
+# Signals that stop the server. The parent passes them on to its workers.
+_STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def _available_cpus() -> list[int]:
+    # CPU affinity is Linux only, elsewhere we let the scheduler decide.
+    # Unlike os.cpu_count(), this respects cgroup/cpuset limits.
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return []
+
+
+def _parse_args(cpus: list[int]):
     parser = ArgumentParser(description="Simple DNS server")
     parser.add_argument(
         "--resolver", type=str, help="The address of the resolver DNS server"
@@ -127,20 +449,92 @@ def main():
         help="The port of the DNS server",
         default=2053,
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="The number of worker processes serving requests",
+        default=len(cpus) or os.cpu_count() or 1,
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
 
-    # AF_INET means we're using IPv4
-    # SOCK_DGRAM specifies UDP protocol (as opposed to TCP which would be SOCK_STREAM)
-    # DGRAM stands for (User) DataGram (Protocol), or UDP for short ;)
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-    udp_socket.bind(("127.0.0.1", int(args.port)))
+def _run_worker_process(port: int, resolver: str | None, cpu: int | None):
+    # The worker must never return into the parent's loop, so we always
+    # leave through os._exit, with a status telling the parent how it went
+    try:
+        _run_worker(port, resolver, cpu)
+    except KeyboardInterrupt:
+        # Ctrl-C reaches every worker, there's no need for a traceback from each
+        os._exit(0)
+    except SystemExit as e:
+        os._exit(0 if e.code in (None, 0) else 1)
+    except BaseException:
+        traceback.print_exc()
+        sys.stderr.flush()
+        os._exit(1)
+    os._exit(0)
 
-    if args.resolver:
-        address, port = args.resolver.split(":")
-        _run_forwarding_server(udp_socket, address, int(port))
-    else:
-        _run_server(udp_socket)
+
+def main():
+    cpus = _available_cpus()
+    args = _parse_args(cpus)
+
+    # Forked workers share the parent's memory pages until they're written to.
+    # Moving everything allocated so far out of the GC's reach keeps
+    # the workers' collections from touching (and thus copying) those pages.
+    gc.freeze()
+
+    workers = []
+    stopping = False
+
+    def stop_workers(signum, frame):
+        # Left alone, workers outlive the parent and keep serving on the port.
+        # With SO_REUSEPORT, a restarted server would then share it with them.
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for signum in _STOP_SIGNALS:
+        signal.signal(signum, stop_workers)
+
+    # Answering a query doesn't depend on any shared state,
+    # so we can simply fork a process per core
+    for i in range(args.workers):
+        cpu = cpus[i % len(cpus)] if cpus else None
+
+        # Hold off stop signals while forking, so none slips in
+        # between the fork and the worker being tracked (or set up)
+        signal.pthread_sigmask(signal.SIG_BLOCK, _STOP_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            # Workers simply exit on these rather than running our handler
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+            _run_worker_process(int(args.port), args.resolver, cpu)
+        workers.append(pid)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+
+        if stopping:
+            break
+
+    failed = False
+    for pid in workers:
+        _, status = os.waitpid(pid, 0)
+        exit_code = os.waitstatus_to_exitcode(status)
+        # Workers we terminated ourselves didn't fail
+        if exit_code != 0 and not (stopping and exit_code == -signal.SIGTERM):
+            failed = True
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+import ctypes
+import errno
+import os
+import socket
+
+# The standard library only lets us move one datagram per syscall.
+# On Linux, recvmmsg(2) and sendmmsg(2) move a whole batch at once,
+# so we reach for them through ctypes when they are around.
+# https://man7.org/linux/man-pages/man2/recvmmsg.2.html
+_libc = ctypes.CDLL(None, use_errno=True)
+_recvmmsg = getattr(_libc, "recvmmsg", None)
+_sendmmsg = getattr(_libc, "sendmmsg", None)
+
+SUPPORTED = _recvmmsg is not None and _sendmmsg is not None
+
+# Big enough for any socket address (struct sockaddr_storage)
+SOCKADDR_SIZE = 128
+
+
+class _IOVec(ctypes.Structure):
+    # iov_base is declared as char* rather than void* so that assigning a
+    # bytes object points straight at its buffer, and ctypes keeps it alive
+    _fields_ = [
+        ("iov_base", ctypes.c_char_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),  # socklen_t
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _MsgHdr),
+        # Number of bytes received (or sent) for this message
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+if SUPPORTED:
+    _recvmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.c_void_p,  # struct mmsghdr *
+        ctypes.c_uint,
+        ctypes.c_int,
+        ctypes.c_void_p,
+    ]
+    _recvmmsg.restype = ctypes.c_int
+    _sendmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.c_void_p,  # struct mmsghdr *
+        ctypes.c_uint,
+        ctypes.c_int,
+    ]
+    _sendmmsg.restype = ctypes.c_int
+
+
+class MessageBatch:
+    """
+    Receives up to `size` datagrams per syscall into a preallocated pool,
+    and sends one response back to the sender of each of them.
+
+    All buffers and message headers are allocated once and reused,
+    so a batch round trip doesn't allocate anything per packet
+    besides the responses themselves.
+    """
+
+    def __init__(self, udp_socket: socket.SocketType, size: int = 32, mtu: int = 512):
+        self.size = size
+        self._fd = udp_socket.fileno()
+        self._mtu = mtu
+
+        # One contiguous pool, each datagram gets an `mtu` sized slot
+        self._pool = ctypes.create_string_buffer(size * mtu)
+        self._view = memoryview(self._pool).cast("B")
+        self._names = ctypes.create_string_buffer(size * SOCKADDR_SIZE)
+        self._recv_iovecs = (_IOVec * size)()
+        self._headers = (_MMsgHdr * size)()
+        # A response goes out as its ID followed by the rest of it,
+        # so every send slot gets a pair of iovecs. The ID is always 2 bytes,
+        # so rather than pointing at it we copy it into a slot of our own.
+        self._send_iovecs = (_IOVec * (2 * size))()
+        self._ids = ctypes.create_string_buffer(2 * size)
+        self._ids_view = memoryview(self._ids).cast("B")
+        self._send_headers = (_MMsgHdr * size)()
+
+        pool_address = ctypes.addressof(self._pool)
+        names_address = ctypes.addressof(self._names)
+        ids_address = ctypes.addressof(self._ids)
+        self._name_addresses = []
+        for i in range(size):
+            self._name_addresses.append(names_address + i * SOCKADDR_SIZE)
+            self._recv_iovecs[i].iov_base = pool_address + i * mtu
+            self._recv_iovecs[i].iov_len = mtu
+            header = self._headers[i].msg_hdr
+            header.msg_name = self._name_addresses[i]
+            header.msg_namelen = SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self._recv_iovecs[i])
+            header.msg_iovlen = 1
+            send_header = self._send_headers[i].msg_hdr
+            send_header.msg_iov = ctypes.pointer(self._send_iovecs[2 * i])
+            send_header.msg_iovlen = 2
+            self._send_iovecs[2 * i].iov_base = ids_address + 2 * i
+            self._send_iovecs[2 * i].iov_len = 2
+
+        # Indexing a ctypes array builds a new wrapper object every time,
+        # so we look up the ones we touch per packet just once
+        self._received = [self._headers[i] for i in range(size)]
+        self._received_headers = [header.msg_hdr for header in self._received]
+        self._send_slots = [
+            (self._send_headers[i].msg_hdr, self._send_iovecs[2 * i + 1])
+            for i in range(size)
+        ]
+        self._count = 0
+
+    def recv(self) -> int:
+        """
+        Reads whatever is queued on the socket, without blocking.
+
+        Returns:
+            int: The number of datagrams received (0 if there was nothing to read)
+        """
+        # The kernel overwrites this with the actual length of each address,
+        # so we put it back, but only where the last call received something
+        for header in self._received_headers[: self._count]:
+            header.msg_namelen = SOCKADDR_SIZE
+
+        count = _recvmmsg(self._fd, self._headers, self.size, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            self._count = 0
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise OSError(err, os.strerror(err))
+        self._count = count
+        return count
+
+    def datagram(self, index: int) -> memoryview:
+        start = index * self._mtu
+        return self._view[start : start + self._received[index].msg_len]
+
+    def send(self, responses: list[list[bytes] | None]) -> None:
+        """
+        Sends responses[i] to whoever sent datagram i of the last `recv`,
+        skipping datagrams whose response is None.
+        Each response is a pair of pieces (the ID and the rest of the message),
+        which the kernel gathers into one datagram.
+        """
+        # Bound to locals, as the loop below runs for every packet
+        send_slots = self._send_slots
+        name_addresses = self._name_addresses
+        received_headers = self._received_headers
+        ids_view = self._ids_view
+
+        total = 0
+        for i, response in enumerate(responses):
+            if response is None:
+                continue
+
+            header, body_iovec = send_slots[total]
+            # The sender's address is still sitting in its slot from recv
+            header.msg_name = name_addresses[i]
+            header.msg_namelen = received_headers[i].msg_namelen
+
+            packet_id, body = response
+            ids_view[2 * total : 2 * total + 2] = packet_id
+            body_iovec.iov_base = body
+            body_iovec.iov_len = len(body)
+            total += 1
+
+        sent = 0
+        while sent < total:
+            count = _sendmmsg(
+                self._fd,
+                ctypes.byref(self._send_headers, sent * ctypes.sizeof(_MMsgHdr)),
+                total - sent,
+                0,
+            )
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # The send buffer is full. This is UDP, the client will retry.
+                    return
+                raise OSError(err, os.strerror(err))
+            sent += count
@@ -0,0 +1,85 @@
+"""
+Compares the two ways a worker drains its socket: one datagram per syscall
+(_drain) and batches through recvmmsg/sendmmsg (_drain_batches).
+
+Each round queues up a burst of queries on a local socket,
+times how long a drain takes to answer all of them, then reads the answers.
+
+    python benchmark.py [rounds]
+"""
+
+import socket
+import statistics
+import sys
+import time
+from functools import partial
+
+from app import mmsg
+from app.main import _drain, _drain_batches, _grow_socket_buffers
+from app.mmsg import MessageBatch
+
+BURST = 4000
+
+
+def _query(packet_id: int, name: bytes) -> bytes:
+    header = packet_id.to_bytes(2, "big") + b"\x01\x00\x00\x01" + b"\x00" * 6
+    labels = b"".join(bytes((len(label),)) + label for label in name.split(b"."))
+    return header + labels + b"\x00\x00\x01\x00\x01"
+
+
+def _time_drain(drain, client, address, queries) -> float:
+    for i in range(BURST):
+        client.sendto(queries[i % len(queries)], address)
+
+    start = time.perf_counter()
+    drain()
+    elapsed = time.perf_counter() - start
+
+    answered = 0
+    client.setblocking(False)
+    while True:
+        try:
+            client.recv(512)
+            answered += 1
+        except BlockingIOError:
+            break
+    client.setblocking(True)
+    assert answered == BURST, f"only {answered} of {BURST} queries were answered"
+
+    # Microseconds per packet
+    return elapsed / BURST * 1e6
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    queries = [_query(i, b"host%d.codecrafters.io" % (i % 50)) for i in range(64)]
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.setblocking(False)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # The whole burst has to fit in the queues, both ways
+    _grow_socket_buffers(server)
+    _grow_socket_buffers(client)
+    address = server.getsockname()
+
+    drains = {"single": partial(_drain, server, bytearray(512))}
+    if mmsg.SUPPORTED:
+        drains["batched"] = partial(_drain_batches, MessageBatch(server))
+
+    timings = {name: [] for name in drains}
+    for _ in range(rounds + 1):
+        for name, drain in drains.items():
+            timings[name].append(_time_drain(drain, client, address, queries))
+
+    for name, results in timings.items():
+        # The first round warms up the caches, so we leave it out
+        results = results[1:]
+        print(
+            f"{name:>8}: median {statistics.median(results):.2f}us/packet, "
+            f"best {min(results):.2f}us/packet"
+        )
+
+
+if __name__ == "__main__":
+    main()